@@ -9,6 +9,8 @@ PROJECT_DIR="/home/Adam/repos/casette"
 SERVICE_NAME="casette-usb-monitor"
 SERVICE_FILE="$PROJECT_DIR/$SERVICE_NAME.service"
 SYSTEMD_DIR="/etc/systemd/system"
+UDEV_RULE_FILE="$PROJECT_DIR/99-casette-usb.rules"
+UDEV_RULES_DIR="/etc/udev/rules.d"
 
 # Colors for output
 RED='\033[0;31m'
@@ -159,6 +161,19 @@ EOF
     print_status "Sudoers configuration completed."
 }
 
+# Function to install the udev rule that tags USB partitions
+install_udev_rule() {
+    print_status "Installing udev rule..."
+    
+    # Copy rule file to udev rules directory
+    sudo cp "$UDEV_RULE_FILE" "$UDEV_RULES_DIR/"
+    
+    # Reload rules so the tag applies to newly inserted devices
+    sudo udevadm control --reload-rules
+    
+    print_status "Udev rule installed."
+}
+
 # Function to install systemd service
 install_service() {
     print_status "Installing systemd service..."
@@ -222,6 +237,10 @@ uninstall_service() {
     # Remove sudoers file
     sudo rm -f "/etc/sudoers.d/casette-usb-monitor"
     
+    # Remove udev rule
+    sudo rm -f "$UDEV_RULES_DIR/$(basename "$UDEV_RULE_FILE")"
+    sudo udevadm control --reload-rules 2>/dev/null || true
+    
     # Clean up any mounted devices
     "$PROJECT_DIR/scripts/mount_helper.sh" cleanup 2>/dev/null || true
     
@@ -268,6 +287,7 @@ install_casette() {
     install_python_deps
     create_directories
     configure_sudoers
+    install_udev_rule
     install_service
     enable_service
     check_service_status
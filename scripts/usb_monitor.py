@@ -9,9 +9,17 @@ This service monitors for USB drive insertions using udev and automatically:
 """
 
 import os
+import errno
+import stat
 import sys
+import shutil
+import signal
 import time
+import ctypes
 import logging
+import logging.handlers
+import queue
+import selectors
 import subprocess
 import threading
 from pathlib import Path
@@ -21,53 +29,132 @@ import pyudev
 MOUNT_BASE = "/mnt/casette"
 LOG_FILE = "/home/Adam/repos/casette/logs/usb_monitor.log"
 DISPLAY = ":0"  # Default X display
+UDEV_TAG = "casette_usb"  # Set on USB partitions by 99-casette-usb.rules
+MONITOR_RCVBUF_SIZE = 8 * 1024 * 1024  # Netlink receive buffer for udev event bursts
+CHROMIUM_EXIT_TIMEOUT = 2.0  # Seconds to wait for killed Chromium processes to exit
+CHROMIUM_EXIT_POLL = 0.1  # Interval between exit checks
 
-# Set up logging
+
+class AppendFileHandler(logging.StreamHandler):
+    """Log handler writing to a line-buffered, append-only, close-on-exec file"""
+    
+    def __init__(self, filename):
+        fd = os.open(filename, os.O_WRONLY | os.O_APPEND | os.O_CREAT | os.O_CLOEXEC, 0o644)
+        super().__init__(os.fdopen(fd, 'a', buffering=1))
+    
+    def close(self):
+        self.acquire()
+        try:
+            try:
+                self.flush()
+                self.stream.close()
+            finally:
+                super().close()
+        finally:
+            self.release()
+
+
+# Set up logging: records are queued and written to file/stdout by a background listener
+log_queue = queue.SimpleQueue()
+log_listener = logging.handlers.QueueListener(
+    log_queue,
+    AppendFileHandler(LOG_FILE),
+    logging.StreamHandler(sys.stdout)
+)
+log_listener.start()
 logging.basicConfig(
     level=logging.INFO,
     format='%(asctime)s - %(levelname)s - %(message)s',
-    handlers=[
-        logging.FileHandler(LOG_FILE),
-        logging.StreamHandler(sys.stdout)
-    ]
+    handlers=[logging.handlers.QueueHandler(log_queue)]
 )
 logger = logging.getLogger(__name__)
 
+# Mount flags from <sys/mount.h>
+MS_RDONLY = 0x1
+MS_NOSUID = 0x2
+MS_NODEV = 0x4
+MS_NOEXEC = 0x8
+MNT_FORCE = 0x1
+MNT_DETACH = 0x2
+
+# USB content is only read by Chromium, so mount it read-only and without exec/suid/device files
+MOUNT_FLAGS = MS_NOSUID | MS_NODEV | MS_NOEXEC | MS_RDONLY
+MOUNT_OPTIONS = 'ro,nosuid,nodev,noexec'
+
+# Direct mount(2)/umount2(2) access, used instead of forking 'sudo mount' when running as root
+_libc = ctypes.CDLL('libc.so.6', use_errno=True)
+_libc.mount.argtypes = [ctypes.c_char_p, ctypes.c_char_p, ctypes.c_char_p, ctypes.c_ulong, ctypes.c_void_p]
+_libc.mount.restype = ctypes.c_int
+_libc.umount2.argtypes = [ctypes.c_char_p, ctypes.c_int]
+_libc.umount2.restype = ctypes.c_int
+
+
+def sys_mount(source, target, fstype, flags=0):
+    """Mount source on target with the mount(2) syscall"""
+    if _libc.mount(source.encode(), target.encode(), fstype.encode(), flags, None) != 0:
+        err = ctypes.get_errno()
+        raise OSError(err, os.strerror(err), target)
+
+
+def sys_umount(target, flags=0):
+    """Unmount target with the umount2(2) syscall"""
+    if _libc.umount2(target.encode(), flags) != 0:
+        err = ctypes.get_errno()
+        raise OSError(err, os.strerror(err), target)
+
 
 class USBMonitor:
     def __init__(self):
         self.context = pyudev.Context()
         self.monitor = pyudev.Monitor.from_netlink(self.context)
         self.monitor.filter_by(subsystem='block', device_type='partition')
-        self.mounted_devices = set()
+        self.monitor.filter_by_tag(UDEV_TAG)
+        try:
+            # Enlarge the netlink buffer so bursts of partition events are not dropped
+            self.monitor.set_receive_buffer_size(MONITOR_RCVBUF_SIZE)
+        except EnvironmentError as e:
+            logger.warning(f"Could not set udev monitor receive buffer size: {e}")
+        self.mounted_devices = {}  # Device name -> mount point
+        self._added = set()  # DEVPATHs of mounted devices, forgotten on removal
+        self._chromium_pids = []  # PIDs of Chromium processes launched by this monitor
+        self._chromium_lock = threading.Lock()  # Guards _chromium_pids across the launch thread
+        self._awaiting_fs = set()  # Device names waiting for udev to report a filesystem
+        self._stop = threading.Event()  # Set by SIGINT/SIGTERM to end monitoring
+        
+        # Root can issue mount syscalls directly; otherwise go through sudo
+        self._use_syscalls = os.geteuid() == 0
+        
+        # Resolve the Chromium executable once (Debian uses 'chromium', Ubuntu uses 'chromium-browser')
+        self._chromium_cmd = shutil.which('chromium') or shutil.which('chromium-browser')
+        if not self._chromium_cmd:
+            logger.warning("Chromium executable not found in PATH")
+        
+        # Build the Chromium environment and kiosk mode command once
+        self._chromium_env = {**os.environ, 'DISPLAY': DISPLAY}
+        self._chromium_argv_prefix = [
+            self._chromium_cmd,
+            '--kiosk',
+            '--no-sandbox',
+            '--disable-web-security',
+            '--disable-features=TranslateUI',
+            '--disable-ipc-flooding-protection',
+            '--start-fullscreen',
+        ]
         
         # Ensure mount base directory exists
         os.makedirs(MOUNT_BASE, exist_ok=True)
         
-    def is_usb_device(self, device):
-        """Check if the device is a USB storage device"""
-        try:
-            # Walk up the device tree to find USB subsystem
-            current = device
-            while current:
-                if current.subsystem == 'usb':
-                    return True
-                current = current.parent
-            return False
-        except Exception:
-            return False
-    
-    def get_device_info(self, device):
-        """Extract device information"""
-        device_name = device.get('DEVNAME', '')
-        device_label = device.get('ID_FS_LABEL', '')
-        device_uuid = device.get('ID_FS_UUID', '')
+    def get_device_info(self, props):
+        """Extract device information from a udev properties dict"""
+        device_name = props.get('DEVNAME', '')
+        device_label = props.get('ID_FS_LABEL', '')
+        device_uuid = props.get('ID_FS_UUID', '')
         
         return {
             'name': device_name,
             'label': device_label or f"usb_{device_name.split('/')[-1]}",
             'uuid': device_uuid,
-            'filesystem': device.get('ID_FS_TYPE', 'unknown')
+            'filesystem': props.get('ID_FS_TYPE', 'unknown')
         }
     
     def mount_device(self, device_info):
@@ -76,11 +163,25 @@ class USBMonitor:
         mount_point = os.path.join(MOUNT_BASE, device_info['label'])
         
         try:
-            # Create mount point
-            os.makedirs(mount_point, exist_ok=True)
+            # Create mount point (MOUNT_BASE already exists)
+            try:
+                os.mkdir(mount_point, 0o755)
+            except FileExistsError:
+                pass
+            
+            # Mount the device (the syscall needs an explicit filesystem type)
+            if self._use_syscalls and device_info['filesystem'] != 'unknown':
+                try:
+                    sys_mount(device_name, mount_point, device_info['filesystem'], MOUNT_FLAGS)
+                    logger.info(f"Successfully mounted {device_name} to {mount_point}")
+                    return mount_point
+                except OSError as e:
+                    # No in-kernel driver (e.g. ntfs-3g, FUSE exfat): let mount(8) use its helpers
+                    if e.errno != errno.ENODEV:
+                        logger.error(f"Failed to mount {device_name}: {e}")
+                        return None
             
-            # Mount the device
-            cmd = ['sudo', 'mount', device_name, mount_point]
+            cmd = ['sudo', 'mount', '-o', MOUNT_OPTIONS, device_name, mount_point]
             result = subprocess.run(cmd, capture_output=True, text=True)
             
             if result.returncode == 0:
@@ -94,22 +195,22 @@ class USBMonitor:
             logger.error(f"Error mounting device {device_name}: {e}")
             return None
     
-    def unmount_device(self, device_info):
-        """Unmount the USB device"""
-        mount_point = os.path.join(MOUNT_BASE, device_info['label'])
-        
+    def unmount_device(self, mount_point, flags=MNT_DETACH):
+        """Unmount the USB device mounted at mount_point"""
         try:
-            # Kill any Chromium processes that might be using the mount point
-            self.kill_chromium()
-            
-            # Wait a moment for processes to clean up
-            time.sleep(2)
-            
             # Unmount the device
-            cmd = ['sudo', 'umount', mount_point]
-            result = subprocess.run(cmd, capture_output=True, text=True)
+            if self._use_syscalls:
+                try:
+                    sys_umount(mount_point, flags)
+                    unmounted, error = True, None
+                except OSError as e:
+                    unmounted, error = False, e
+            else:
+                cmd = ['sudo', 'umount', mount_point]
+                result = subprocess.run(cmd, capture_output=True, text=True)
+                unmounted, error = result.returncode == 0, result.stderr
             
-            if result.returncode == 0:
+            if unmounted:
                 logger.info(f"Successfully unmounted {mount_point}")
                 # Remove the mount point directory
                 try:
@@ -117,7 +218,7 @@ class USBMonitor:
                 except OSError:
                     logger.warning(f"Could not remove mount point directory {mount_point}")
             else:
-                logger.error(f"Failed to unmount {mount_point}: {result.stderr}")
+                logger.error(f"Failed to unmount {mount_point}: {error}")
                 
         except Exception as e:
             logger.error(f"Error unmounting device: {e}")
@@ -125,74 +226,137 @@ class USBMonitor:
     def kill_chromium(self):
         """Kill any running Chromium processes"""
         try:
-            subprocess.run(['pkill', '-f', 'chromium'], capture_output=True)
+            # Signal the processes we launched, falling back to a /proc scan
+            with self._chromium_lock:
+                pids = list(self._chromium_pids)
+                self._chromium_pids.clear()
+            if not pids:
+                pids = self.find_chromium_pids()
+            signalled = []
+            for pid in pids:
+                try:
+                    os.kill(pid, signal.SIGTERM)
+                    signalled.append(pid)
+                except OSError:
+                    pass
+            self.wait_for_exit(signalled)
             logger.info("Killed existing Chromium processes")
         except Exception as e:
             logger.warning(f"Could not kill Chromium processes: {e}")
     
+    def wait_for_exit(self, pids):
+        """Wait until the given processes exit, up to CHROMIUM_EXIT_TIMEOUT"""
+        remaining = set(pids)
+        deadline = time.monotonic() + CHROMIUM_EXIT_TIMEOUT
+        while remaining:
+            for pid in list(remaining):
+                try:
+                    # Reap our own children; probe processes we did not spawn
+                    if os.waitpid(pid, os.WNOHANG)[0] != 0:
+                        remaining.discard(pid)
+                except ChildProcessError:
+                    try:
+                        os.kill(pid, 0)
+                    except ProcessLookupError:
+                        remaining.discard(pid)
+                    except PermissionError:
+                        # PID now belongs to another user's process
+                        remaining.discard(pid)
+            if not remaining or time.monotonic() >= deadline:
+                break
+            time.sleep(CHROMIUM_EXIT_POLL)
+        if remaining:
+            logger.warning(f"Chromium processes still running: {sorted(remaining)}")
+    
+    def reap_chromium(self):
+        """Reap launched Chromium processes that have exited on their own"""
+        with self._chromium_lock:
+            for pid in list(self._chromium_pids):
+                try:
+                    if os.waitpid(pid, os.WNOHANG)[0] == 0:
+                        continue
+                except ChildProcessError:
+                    pass
+                self._chromium_pids.remove(pid)
+    
+    def find_chromium_pids(self):
+        """Find this user's running Chromium processes by scanning /proc"""
+        pids = []
+        uid = os.getuid()
+        for entry in os.listdir('/proc'):
+            if not entry.isdigit():
+                continue
+            try:
+                if os.stat(f'/proc/{entry}').st_uid != uid:
+                    continue
+                with open(f'/proc/{entry}/cmdline', 'rb') as f:
+                    cmdline = f.read()
+            except OSError:
+                continue
+            if b'chromium' in cmdline:
+                pids.append(int(entry))
+        return pids
+    
     def launch_chromium(self, html_path):
         """Launch Chromium in kiosk mode with the HTML file"""
         try:
-            # Set environment variables for X display
-            env = os.environ.copy()
-            env['DISPLAY'] = DISPLAY
-            
             # Kill any existing Chromium processes first
             self.kill_chromium()
-            time.sleep(1)
-            
-            # Determine Chromium executable (Debian uses 'chromium', Ubuntu uses 'chromium-browser')
-            chromium_cmd = 'chromium' if subprocess.run(['which', 'chromium'], 
-                                                       capture_output=True).returncode == 0 else 'chromium-browser'
             
-            # Chromium kiosk mode command
-            cmd = [
-                chromium_cmd,
-                '--kiosk',
-                '--no-sandbox',
-                '--disable-web-security',
-                '--disable-features=TranslateUI',
-                '--disable-ipc-flooding-protection',
-                '--start-fullscreen',
-                f'file://{html_path}'
-            ]
+            if not self._chromium_cmd:
+                logger.error("Cannot launch Chromium: executable not found")
+                return None
             
-            # Launch Chromium in background
-            process = subprocess.Popen(
-                cmd,
-                env=env,
-                stdout=subprocess.DEVNULL,
-                stderr=subprocess.DEVNULL
+            # Launch Chromium in background with stdout/stderr sent to /dev/null
+            pid = os.posix_spawn(
+                self._chromium_cmd,
+                self._chromium_argv_prefix + [f'file://{html_path}'],
+                self._chromium_env,
+                file_actions=[
+                    (os.POSIX_SPAWN_OPEN, 1, os.devnull, os.O_WRONLY, 0),
+                    (os.POSIX_SPAWN_DUP2, 1, 2)
+                ],
+                # Undo the SIG_IGN that CPython installs, as subprocess does
+                setsigdef=(signal.SIGPIPE, signal.SIGXFSZ)
             )
             
+            with self._chromium_lock:
+                self._chromium_pids.append(pid)
             logger.info(f"Launched Chromium in kiosk mode with {html_path}")
-            return process
+            return pid
             
         except Exception as e:
             logger.error(f"Error launching Chromium: {e}")
             return None
     
-    def handle_device_add(self, device):
+    def handle_device_add(self, props):
         """Handle USB device insertion"""
-        if not self.is_usb_device(device):
+        device_info = self.get_device_info(props)
+        
+        # Wait for the 'change' event that reports the filesystem before mounting
+        if not props.get('ID_FS_TYPE'):
+            logger.info(f"USB device {device_info['name']} has no filesystem yet, waiting")
+            self._awaiting_fs.add(device_info['name'])
             return
-            
-        device_info = self.get_device_info(device)
-        logger.info(f"USB device inserted: {device_info}")
+        self._awaiting_fs.discard(device_info['name'])
         
-        # Wait a moment for the device to be ready
-        time.sleep(2)
+        logger.info(f"USB device inserted: {device_info}")
         
         # Mount the device
         mount_point = self.mount_device(device_info)
         if not mount_point:
             return
             
-        self.mounted_devices.add(device_info['name'])
+        self.mounted_devices[device_info['name']] = mount_point
         
         # Look for index.html in the root of the mounted device
         index_path = os.path.join(mount_point, 'index.html')
-        if os.path.exists(index_path):
+        try:
+            has_index = stat.S_ISREG(os.stat(index_path).st_mode)
+        except OSError:
+            has_index = False
+        
+        if has_index:
             logger.info(f"Found index.html at {index_path}")
             # Launch Chromium in a separate thread to avoid blocking
             threading.Thread(
@@ -203,63 +367,95 @@ class USBMonitor:
         else:
             logger.info(f"No index.html found in {mount_point}")
     
-    def handle_device_remove(self, device):
+    def handle_device_remove(self, props):
         """Handle USB device removal"""
-        if not self.is_usb_device(device):
-            return
-            
-        device_info = self.get_device_info(device)
+        device_info = self.get_device_info(props)
         device_name = device_info['name']
+        self._awaiting_fs.discard(device_name)
         
-        if device_name in self.mounted_devices:
+        mount_point = self.mounted_devices.pop(device_name, None)
+        if mount_point:
             logger.info(f"USB device removed: {device_info}")
-            self.unmount_device(device_info)
-            self.mounted_devices.discard(device_name)
+            # Kill any Chromium processes that might be using the mount point
+            self.kill_chromium()
+            self.unmount_device(mount_point)
     
     def start_monitoring(self):
         """Start monitoring for USB device events"""
         logger.info("Starting USB device monitoring...")
         
+        selector = selectors.DefaultSelector()
+        # Signals wake the selector through a pipe so shutdown needs no polling
+        wakeup_r, wakeup_w = os.pipe()
+        os.set_blocking(wakeup_r, False)
+        os.set_blocking(wakeup_w, False)
         try:
-            # Start the udev monitor
-            observer = pyudev.MonitorObserver(self.monitor, self.handle_udev_event)
-            observer.start()
+            signal.signal(signal.SIGINT, lambda *_: self._stop.set())
+            signal.signal(signal.SIGTERM, lambda *_: self._stop.set())
+            signal.set_wakeup_fd(wakeup_w)
+            selector.register(wakeup_r, selectors.EVENT_READ)
+            
+            # Start the udev monitor and wait on its netlink socket directly
+            self.monitor.start()
+            selector.register(self.monitor.fileno(), selectors.EVENT_READ)
             
             logger.info("USB monitor started successfully. Press Ctrl+C to stop.")
             
-            # Keep the main thread alive
-            while True:
-                time.sleep(1)
-                
-        except KeyboardInterrupt:
-            logger.info("Received interrupt signal, stopping monitor...")
-            observer.stop()
+            # Sleep until the kernel delivers a udev event, then drain every queued event
+            while not self._stop.is_set():
+                for key, _events in selector.select(timeout=None):
+                    if key.fd == wakeup_r:
+                        os.read(wakeup_r, 512)
+                while True:
+                    device = self.monitor.poll(timeout=0)
+                    if device is None:
+                        break
+                    self.handle_udev_event(device)
+                self.reap_chromium()
+            
+            logger.info("Received stop signal, stopping monitor...")
         except Exception as e:
             logger.error(f"Error in USB monitor: {e}")
         finally:
+            signal.set_wakeup_fd(-1)
+            selector.close()
+            os.close(wakeup_r)
+            os.close(wakeup_w)
             # Clean up any mounted devices
             self.cleanup()
     
     def handle_udev_event(self, device):
         """Handle udev events"""
         action = device.action
+        # Read all udev properties in one pass
+        props = dict(device.properties)
+        
+        devpath = props.get('DEVPATH')
         
         if action == 'add':
-            self.handle_device_add(device)
+            # Skip repeated 'add' events (e.g. from udevadm trigger) for a device already mounted
+            if devpath in self._added:
+                return
+            self.handle_device_add(props)
+        elif action == 'change' and props.get('DEVNAME') in self._awaiting_fs:
+            self.handle_device_add(props)
         elif action == 'remove':
-            self.handle_device_remove(device)
+            self._added.discard(devpath)
+            self.handle_device_remove(props)
+            return
+        
+        # Only a successful mount stops later 'add' events from retrying
+        if props.get('DEVNAME') in self.mounted_devices:
+            self._added.add(devpath)
     
     def cleanup(self):
         """Clean up mounted devices on shutdown"""
         logger.info("Cleaning up mounted devices...")
-        for device_name in list(self.mounted_devices):
-            # This is a simplified cleanup - in a real scenario,
-            # we'd need to track mount points properly
-            try:
-                subprocess.run(['sudo', 'umount', device_name], 
-                             capture_output=True, timeout=10)
-            except Exception:
-                pass
+        if self.mounted_devices:
+            self.kill_chromium()
+        for device_name, mount_point in list(self.mounted_devices.items()):
+            self.unmount_device(mount_point, MNT_DETACH | MNT_FORCE)
+            del self.mounted_devices[device_name]
 
 
 def main():
@@ -272,6 +468,9 @@ def main():
     except Exception as e:
         logger.error(f"Fatal error: {e}")
         sys.exit(1)
+    finally:
+        # Flush queued log records before exiting
+        log_listener.stop()
 
 
 if __name__ == "__main__":